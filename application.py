@@ -1,16 +1,22 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, abort
+from flask import Flask, render_template, redirect, url_for, request, flash, abort, make_response, g
 from flask_gravatar import Gravatar
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, Text, ForeignKey
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, selectinload, joinedload, raiseload, load_only
+from sqlalchemy import Integer, String, Text, Date, ForeignKey, bindparam
+from sqlalchemy.exc import IntegrityError
 from forms import PostForm, RegisterForm, LoginForm, CommentForm
 from flask_ckeditor import CKEditor
-from html_sanitizer import Sanitizer
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_caching import Cache
+from flask_wtf.csrf import CSRFProtect
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
-from functools import wraps
+from functools import wraps, lru_cache
 import datetime
 import os
+import time
 
 
 class Base(DeclarativeBase):
@@ -20,34 +26,74 @@ class Base(DeclarativeBase):
 # edit variable is used to check if the user is editing a post or creating a new post.
 edit = False
 
-# Allowed Tags for the html-sanitizer
-Tags = {
+# id of the admin user, the first user to register.
+ADMIN_ID = 1
+
+# Allowed Tags for the nh3 html sanitizer.
+Tags = frozenset({
     "a", "h1", "h2", "h3", "strong", "em", "p", "ul", "ol",
     "li", "br", "sub", "sup", "hr", "img",
+})
+
+# Allowed attributes for each of the allowed tags. img tags need their own entry
+# as img attributes are not allowed by default.
+Attributes = {
+    "a": frozenset({"href", "name", "target", "title", "id", "rel"}),
+    "img": frozenset({"alt", "src"}),
 }
 
-# Set up the sanitizer to allow the tags specified in the "Tags" variable.
-# It also will allow img
-# tags as img tags are not allowed by default
-sanitizer = Sanitizer({
-    "tags": Tags,
-    "attributes": {
-        "a": ("href", "name", "target", "title", "id", "rel"),
-        "img": {"alt", "src"}
-    },
-    "empty": {"hr", "a", "br", "img"},
-})
+
+# Set up the sanitizer with the allowed tags and attributes the first time it's needed, and reuse it after that.
+# nh3 is only imported here, so workers that never receive a post or comment don't load it.
+# link_rel is set to None so the "rel" attribute from the editor is kept instead of being replaced by nh3.
+@lru_cache(maxsize=1)
+def get_sanitizer():
+    import nh3
+    return nh3.Cleaner(tags=Tags, attributes=Attributes, link_rel=None)
+
+
+# Sanitizes the HTML submitted from the editor so only the allowed tags and attributes are kept.
+def sanitize(html):
+    # Text with no tags or entities has nothing to clean, so skip parsing it.
+    if "<" not in html and "&" not in html:
+        return html
+    return get_sanitizer().clean(html)
+
+
+# Post bodies are large and saved again unchanged when only the title or subtitle is edited, so the last
+# few results are cached. Comments aren't, they're short and rarely sent twice.
+@lru_cache(maxsize=8)
+def sanitize_post_body(html):
+    return sanitize(html)
+
+
+# Argon2id hasher for the user passwords. argon2-cffi hashes in C, outside the GIL,
+# so other requests keep running while a password is hashed.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+
+# Hash that is checked when no user has the given email, so logging in with an unknown email
+# takes as long as logging in with a wrong password.
+DUMMY_HASH = password_hasher.hash("x" * 16)
+
+
+# Checks a password against the hash stored for the user. Users that registered before Argon2 was
+# used still have Werkzeug pbkdf2 hashes, so those are checked with Werkzeug instead.
+def verify_password(password_hash, password):
+    if not password_hash.startswith("$argon2"):
+        return check_password_hash(password_hash, password)
+    try:
+        return password_hasher.verify(password_hash, password)
+    except VerifyMismatchError:
+        return False
 
 
 # Decorator used for admin access
 def admin_only(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # if the user has not logged return abort with 403 error
-        if current_user.is_anonymous:
-            return abort(403)
-        # if the user is not an admin return abort with 403 error
-        if current_user.id != 1:
+        # if the user is not logged in as the admin return abort with 403 error
+        if not g.get("is_admin"):
             return abort(403)
         # Otherwise continue with the route function
         return f(*args, **kwargs)
@@ -55,18 +101,115 @@ def admin_only(f):
     return decorated_function
 
 
+# Returns the version of the blog posts stored in the database. It's read at most once per request.
+def posts_version():
+    if "posts_version" not in g:
+        g.posts_version = db.session.scalar(POSTS_VERSION_STMT)
+    return g.posts_version
+
+
+# Builds the ETag for a page showing blog posts from the version stored in the database, so every worker
+# builds the same ETag for the same content. The ETag also includes the user, as admins see extra links on
+# the same pages, and the hour, so a cached page never holds a CSRF token older than it's valid for.
+def posts_etag(page):
+    return f"{posts_version()}-{current_user.get_id() or 'anon'}-{page}-{int(time.time() // 3600)}"
+
+
+# Called when a post or comment is saved or deleted, before the change is committed. The version is bumped
+# in the same transaction, so the ETags and the cached home page change for every worker along with the posts.
+def bump_posts_version():
+    db.session.execute(db.update(PostsVersion).where(PostsVersion.id == 1).values(version=PostsVersion.version + 1))
+
+
+# Returns a 304 response if the browser already has this version of the page, otherwise None.
+def not_modified(etag):
+    if etag not in request.if_none_match:
+        return None
+    response = make_response("", 304)
+    response.set_etag(etag)
+    return response
+
+
+# Decorator that sends a 304 before the route function runs if the browser already has this version of the page.
+# It goes above @cache.cached, so the check still runs when the page would be served from the cache.
+def check_etag(page):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            cached = not_modified(posts_etag(page))
+            if cached is not None:
+                return cached
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
+# Renders a template with the ETag set, so later requests with a matching If-None-Match get a 304.
+def render_with_etag(etag, template, **context):
+    response = make_response(render_template(template, **context))
+    response.set_etag(etag)
+    response.vary.add("Cookie")
+    return response.make_conditional(request)
+
+
+# Reads the settings from the environment once. A missing variable raises a KeyError at startup
+# instead of the app running without a secret key or database.
+@lru_cache(maxsize=1)
+def settings():
+    return {
+        "SECRET_KEY": os.environ["FLASK_KEY"],
+        "SQLALCHEMY_DATABASE_URI": os.environ["DB_URI"],
+    }
+
+
 application = Flask(__name__)
-application.config['SECRET_KEY'] = os.environ.get('FLASK_KEY')
+application.config.update(settings())
+# Reject request bodies over 256 KB with a 413 before the form data is parsed.
+application.config['MAX_CONTENT_LENGTH'] = 256 * 1024
+
+# Cache compiled templates on disk so new workers don't have to recompile them.
+# Jinja falls back to a private temp directory if JINJA_CACHE_DIR is not set.
+jinja_cache_dir = os.environ.get('JINJA_CACHE_DIR')
+if jinja_cache_dir:
+    os.makedirs(jinja_cache_dir, exist_ok=True)
+application.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=jinja_cache_dir,
+                                                               pattern="__jinja2_%s.cache")
 
 # Initialize the CKEditor
 ckeditor = CKEditor(application)
 
+# Check the CSRF token on every POST, including the delete post buttons that aren't WTForms forms.
+csrf = CSRFProtect(application)
+
+# Cache for the pages that are the same for every visitor that isn't logged in.
+cache = Cache(application, config={"CACHE_TYPE": "SimpleCache"})
+
 # Configure Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(application)
 
-# Connect to the database
-application.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DB_URI']
+# Connect to the database, the database URI is set from settings() above.
+# The app never listens for model change signals or reads the recorded queries, so turn both off.
+application.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+application.config['SQLALCHEMY_RECORD_QUERIES'] = False
+# Keep more compiled SQL statements cached per engine than the default 500, and never log the SQL.
+application.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "query_cache_size": 1200,
+    "echo": False,
+}
+# Size the connection pool for the web workers and check connections before use,
+# so stale MySQL connections are replaced instead of failing a request.
+# These options are skipped for SQLite, as the pool used for in-memory SQLite databases rejects the sizing arguments.
+if not application.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    application.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_timeout": 30,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+    })
 db = SQLAlchemy(model_class=Base)
 db.init_app(application)
 
@@ -81,6 +224,13 @@ gravatar = Gravatar(application,
                     base_url=None)
 
 
+# Looks up the make-post template once and keeps the Template object for the new and edit post pages.
+# render_template accepts the Template directly, so the context processors still run but the loader is skipped.
+@lru_cache(maxsize=1)
+def make_post_template():
+    return application.jinja_env.get_template("make-post.html")
+
+
 # Configure database Tables
 
 # User Table
@@ -93,10 +243,11 @@ class User(db.Model, UserMixin):
     name: Mapped[str] = mapped_column(String(250), nullable=False)
 
     # One-to-many relationship with the Blog posts.
-    posts: Mapped[list["BlogPost"]] = relationship(back_populates="author")
+    # These are never shown from the user's side, so loading them lazily raises an error instead of running more queries.
+    posts: Mapped[list["BlogPost"]] = relationship(back_populates="author", lazy="raise")
 
     # One-to-many relationship with the Comments.
-    comments: Mapped[list["Comment"]] = relationship(back_populates="comment_author")
+    comments: Mapped[list["Comment"]] = relationship(back_populates="comment_author", lazy="raise")
 
 
 # Blogpost Table
@@ -106,42 +257,91 @@ class BlogPost(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
     subtitle: Mapped[str] = mapped_column(String(250), nullable=False)
-    date: Mapped[str] = mapped_column(String(250), nullable=False)
+    date: Mapped[datetime.date] = mapped_column(Date, nullable=False, index=True)
     body: Mapped[str] = mapped_column(Text, nullable=False)
     img_url: Mapped[str] = mapped_column(String(250), nullable=False)
 
     # Many-to-one relationship with the User.
-    author_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
+    author_id: Mapped[int] = mapped_column(ForeignKey("user.id"), index=True)
     author: Mapped["User"] = relationship(back_populates="posts")
 
     # One-to-many relationship with the Comments.
-    comments: Mapped[list["Comment"]] = relationship(back_populates="parent_post")
+    # The comments are deleted along with the post without being loaded first, see delete_post.
+    comments: Mapped[list["Comment"]] = relationship(back_populates="parent_post",
+                                                     cascade="all, delete-orphan", passive_deletes=True)
 
 
 # Comments Table
 class Comment(db.Model):
     __tablename__ = 'comments'
+    # The post page loads the comments by post_id, this index also covers post_id on its own.
+    __table_args__ = (db.Index("ix_comments_post_author", "post_id", "author_id"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     text: Mapped[str] = mapped_column(Text, nullable=False)
 
     # Many-to-one relationship with the User.
     comment_author: Mapped["User"] = relationship(back_populates="comments")
-    author_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
+    author_id: Mapped[int] = mapped_column(ForeignKey("user.id"), index=True)
 
     # Many-to-one relationship with the Blog Posts.
     parent_post: Mapped["BlogPost"] = relationship(back_populates="comments")
-    post_id: Mapped[int] = mapped_column(ForeignKey("blogpost.id"))
+    post_id: Mapped[int] = mapped_column(ForeignKey("blogpost.id", ondelete="CASCADE"))
+
+
+# Single row table holding the version of the blog posts and comments, used for the ETags and the home page cache.
+class PostsVersion(db.Model):
+    __tablename__ = 'posts_version'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
 
 
 with application.app_context():
     db.create_all()
+    # Add the version row if this is a new database. Another worker starting at the same time may add it first.
+    if db.session.get(PostsVersion, 1) is None:
+        try:
+            db.session.add(PostsVersion(id=1, version=0))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+
+# Statements reused by the route functions, built once instead of on every request.
+# The home page only loads the post columns it shows, and just the name of each author. The authors are
+# joined into the same query, and any other lazy load raises instead of quietly running one query per post.
+# The rows are streamed to the template in batches rather than all loaded up front, newest posts first.
+# The author has to be joined rather than selectin loaded, because streaming keeps the cursor open and MySQL
+# can't run the extra IN query on the same connection until it's closed.
+ALL_POSTS_STMT = db.select(BlogPost).options(
+    load_only(BlogPost.id, BlogPost.title, BlogPost.subtitle, BlogPost.date, BlogPost.img_url, BlogPost.author_id,
+              raiseload=True),
+    joinedload(BlogPost.author).load_only(User.name),
+    raiseload("*"),
+).order_by(BlogPost.date.desc(), BlogPost.id.desc()).execution_options(yield_per=100)
+POSTS_VERSION_STMT = db.select(PostsVersion.version).where(PostsVersion.id == 1)
+USER_BY_EMAIL_STMT = db.select(User).where(User.email == bindparam("email"))
+# The post page shows the author, the comments and each comment's author, so load them all with the post.
+POST_PAGE_OPTIONS = [
+    joinedload(BlogPost.author),
+    selectinload(BlogPost.comments).joinedload(Comment.comment_author),
+]
+
+
+# Works out once per request whether the admin is logged in, so admin_only and the templates
+# only need to check g.is_admin. Static files don't need it, so they don't load the user.
+@application.before_request
+def check_admin():
+    if request.endpoint == "static":
+        return
+    g.is_admin = current_user.is_authenticated and current_user.id == ADMIN_ID
 
 
 # Flask-login callback. This callback is used to reload the user object from the user ID stored in the session
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.execute(db.select(User).where(User.id == user_id)).scalar()
+    return db.session.get(User, int(user_id))
 
 
 # TODO: Use Werkzeug to hash the user's password when creating a new user.
@@ -149,14 +349,14 @@ def load_user(user_id):
 def register():
     register_form = RegisterForm()
     if register_form.validate_on_submit():
-        registered_user = db.session.execute(db.select(User).where(User.email == register_form.email.data)).scalar()
+        registered_user = db.session.scalar(USER_BY_EMAIL_STMT, {"email": register_form.email.data})
         if registered_user is not None:
             flash("You've already signed up with that email, log in instead!")
             return redirect(url_for('login'))
 
         new_user = User(
             email=register_form.email.data,
-            password=generate_password_hash(register_form.password.data, method="pbkdf2"),
+            password=password_hasher.hash(register_form.password.data),
             name=register_form.name.data
         )
         db.session.add(new_user)
@@ -171,14 +371,17 @@ def register():
 def login():
     login_form = LoginForm()
     if login_form.validate_on_submit():
-        user = db.session.execute(db.select(User).where(User.email == login_form.email.data)).scalar()
-
-        if user is None:
-            flash("That email does not exist, please try again.")
-            return redirect(url_for('login'))
-        if not check_password_hash(user.password, login_form.password.data):
-            flash("Password incorrect, please try again.")
+        user = db.session.scalar(USER_BY_EMAIL_STMT, {"email": login_form.email.data})
+        # A hash is always checked and the same message is shown either way,
+        # so the login page doesn't reveal which emails are registered.
+        password_hash = user.password if user is not None else DUMMY_HASH
+        if not verify_password(password_hash, login_form.password.data) or user is None:
+            flash("Invalid email or password, please try again.")
             return redirect(url_for('login'))
+        # Replace old pbkdf2 hashes, or Argon2 hashes made with different settings, now the password is known.
+        if not user.password.startswith("$argon2") or password_hasher.check_needs_rehash(user.password):
+            user.password = password_hasher.hash(login_form.password.data)
+            db.session.commit()
         login_user(user)
         return redirect(url_for('home'))
     return render_template("login.html", form=login_form)
@@ -192,30 +395,43 @@ def logout():
 
 
 @application.route('/')
+# Browsers that already have the current page get a 304 from check_etag, before the cache is looked up.
+# The full page is cached for everyone else, and the cache key includes the posts version, so a change
+# made through any worker is shown straight away.
+@check_etag("all")
+@cache.cached(timeout=60, key_prefix=lambda: f"home-{posts_version()}",
+              unless=lambda: current_user.is_authenticated,
+              response_filter=lambda response: response.status_code == 200)
 def home():
-    posts = db.session.execute(db.select(BlogPost)).scalars().all()
-    return render_template("index.html", all_posts=posts)
+    posts = db.session.scalars(ALL_POSTS_STMT)
+    return render_with_etag(posts_etag("all"), "index.html", all_posts=posts)
 
 
 # TODO: Allow logged-in users to comment on posts
 @application.route('/post/<int:post_id>', methods=['GET', 'POST'])
 def show_post(post_id):
-    comment_form = CommentForm()
-    requested_post = db.session.execute(db.select(BlogPost).where(BlogPost.id == post_id)).scalar()
-    if comment_form.validate_on_submit():
+    etag = posts_etag(post_id)
+    cached = not_modified(etag) if request.method == "GET" else None
+    if cached is not None:
+        return cached
+    # The comment form is only shown to logged-in users, so don't build it for anyone else viewing the post.
+    comment_form = CommentForm() if request.method == "POST" or current_user.is_authenticated else None
+    requested_post = db.session.get(BlogPost, post_id, options=POST_PAGE_OPTIONS)
+    if comment_form is not None and comment_form.validate_on_submit():
         if not current_user.is_authenticated:
             flash("You need to login or register to comment.")
             return redirect(url_for("login"))
-        clean_data = sanitizer.sanitize(comment_form.comment.data)
+        clean_data = sanitize(comment_form.comment.data)
         new_comment = Comment(
             text=clean_data,
             author_id=current_user.id,
             post_id=requested_post.id
         )
         db.session.add(new_comment)
+        bump_posts_version()
         db.session.commit()
         return redirect(url_for('show_post', post_id=post_id))
-    return render_template("post.html", post=requested_post, form=comment_form)
+    return render_with_etag(etag, "post.html", post=requested_post, form=comment_form)
 
 
 # TODO: Use a decorator so only an admin user can create a new post
@@ -225,21 +441,21 @@ def add_new_post():
     edit = False
     post_form = PostForm()
     if post_form.validate_on_submit():
-        current_date = datetime.datetime.now()
         # Sanitizes the HTML from the body bore storing it in the database.
-        clean_data = sanitizer.sanitize(post_form.body.data)
-        new_post = BlogPost(
+        clean_data = sanitize_post_body(post_form.body.data)
+        # The new post isn't used after it's saved, so insert the row directly instead of adding an ORM object.
+        db.session.execute(db.insert(BlogPost).values(
             title=post_form.title.data,
             subtitle=post_form.subtitle.data,
             author_id=current_user.id,
-            date=current_date.strftime("%B %d, %Y"),
+            date=datetime.date.today(),
             body=clean_data,
             img_url=post_form.img_url.data
-        )
-        db.session.add(new_post)
+        ))
+        bump_posts_version()
         db.session.commit()
         return redirect(url_for("home"))
-    return render_template("make-post.html", form=post_form, edit=edit)
+    return render_template(make_post_template(), form=post_form, edit=edit)
 
 
 # TODO: Use a decorator so only an admin user can edit a post
@@ -248,40 +464,59 @@ def add_new_post():
 def edit_post(post_id):
     edit = True
     edit_form = PostForm()
-    current_post = db.session.execute(db.select(BlogPost).where(BlogPost.id == post_id)).scalar()
     if edit_form.validate_on_submit():
-        current_post.title = edit_form.title.data
-        current_post.subtitle = edit_form.subtitle.data
-        current_post.body = sanitizer.sanitize(edit_form.body.data)
-        current_post.img_url = edit_form.img_url.data
+        # Update the post with a single UPDATE instead of loading it first.
+        result = db.session.execute(db.update(BlogPost).where(BlogPost.id == post_id).values(
+            title=edit_form.title.data,
+            subtitle=edit_form.subtitle.data,
+            body=sanitize_post_body(edit_form.body.data),
+            img_url=edit_form.img_url.data
+        ))
+        if result.rowcount == 0:
+            return abort(404)
+        bump_posts_version()
         db.session.commit()
         return redirect(url_for("show_post", post_id=post_id))
 
-    if (request.method == "GET") and (current_post is not None):
-        edit_form.title.data = current_post.title
-        edit_form.subtitle.data = current_post.subtitle
-        edit_form.body.data = current_post.body
-        edit_form.img_url.data = current_post.img_url
+    if request.method == "GET":
+        # Only the columns shown in the form are needed to fill it in.
+        current_post = db.session.execute(
+            db.select(BlogPost.title, BlogPost.subtitle, BlogPost.body, BlogPost.img_url).where(BlogPost.id == post_id)
+        ).one_or_none()
+        if current_post is not None:
+            edit_form.title.data = current_post.title
+            edit_form.subtitle.data = current_post.subtitle
+            edit_form.body.data = current_post.body
+            edit_form.img_url.data = current_post.img_url
 
-    return render_template("make-post.html", form=edit_form, edit=edit, id=post_id)
+    return render_template(make_post_template(), form=edit_form, edit=edit, id=post_id)
 
 
 # TODO: Use a decorator so only an admin user can delete a post
-@application.route("/delete/<int:post_id>", methods=["GET"])
+@application.route("/delete/<int:post_id>", methods=["POST"])
 @admin_only
 def delete_post(post_id):
-    post = db.session.execute(db.select(BlogPost).where(BlogPost.id == post_id)).scalar()
-    db.session.delete(post)
+    # Delete the comments and then the post in the same transaction, without loading either of them first.
+    # The comments are deleted here rather than left to ON DELETE CASCADE, as SQLite doesn't enforce foreign
+    # keys by default and older databases were created without the cascade.
+    db.session.execute(db.delete(Comment).where(Comment.post_id == post_id))
+    result = db.session.execute(db.delete(BlogPost).where(BlogPost.id == post_id))
+    if result.rowcount == 0:
+        db.session.rollback()
+        return abort(404)
+    bump_posts_version()
     db.session.commit()
     return redirect(url_for("home"))
 
 
 @application.route("/about")
+@cache.cached(timeout=3600, unless=lambda: current_user.is_authenticated)
 def about():
     return render_template("about.html")
 
 
 @application.route("/contact")
+@cache.cached(timeout=3600, unless=lambda: current_user.is_authenticated)
 def contact():
     return render_template("contact.html")
 
@@ -12,7 +12,8 @@ class PostForm(FlaskForm):
                                                                            message="Subtitle must be between %(min)d and %(max)d characters.")])
     img_url = URLField("Blog Image URL", validators=[InputRequired(), URL(), Length(min=1, max=250,
                                                                                     message="The Blog Image URL must be between %(min)d and %(max)d characters.")])
-    body = CKEditorField("Blog Content", validators=[InputRequired()])
+    body = CKEditorField("Blog Content", validators=[InputRequired(), Length(max=128000,
+                                                                             message="Blog Content must be at most %(max)d characters.")])
     submit = SubmitField("SUBMIT POST")
 
 
@@ -35,5 +36,6 @@ class LoginForm(FlaskForm):
 
 # CommentForm so users can leave comments below posts
 class CommentForm(FlaskForm):
-    comment = CKEditorField("Comment", validators=[InputRequired()])
+    comment = CKEditorField("Comment", validators=[InputRequired(), Length(max=128000,
+                                                                           message="Comment must be at most %(max)d characters.")])
     submit = SubmitField("SUBMIT COMMENT")
@@ -0,0 +1,69 @@
+# One-off script to bring a database created by an older version of the blog up to date with the models in
+# application.py. db.create_all() only creates missing tables, so the existing tables are updated here:
+#   - blogpost.date is converted from "October 14, 2024" strings to dates, and on MySQL to a DATE column.
+#   - The indexes declared on the models are created if they are missing.
+#   - On MySQL, the comments foreign key to blogpost is recreated with ON DELETE CASCADE.
+# It's safe to run more than once. Run it with the same FLASK_KEY and DB_URI as the app:
+#   python migrate_db.py
+from sqlalchemy import inspect, text, Date
+from application import application, db
+import datetime
+
+
+# Converts the post dates stored as formatted strings into dates.
+def convert_post_dates(connection):
+    columns = {column["name"]: column for column in inspect(connection).get_columns("blogpost")}
+    if isinstance(columns["date"]["type"], Date):
+        return
+
+    rows = connection.execute(text("SELECT id, date FROM blogpost")).all()
+    for post_id, value in rows:
+        try:
+            date = datetime.datetime.strptime(value, "%B %d, %Y").date()
+        except ValueError:
+            # The date has already been converted.
+            continue
+        connection.execute(text("UPDATE blogpost SET date = :date WHERE id = :id"),
+                           {"date": date.isoformat(), "id": post_id})
+
+    # SQLite can't change a column's type, but it reads the YYYY-MM-DD strings back as dates.
+    if connection.dialect.name == "mysql":
+        connection.execute(text("ALTER TABLE blogpost MODIFY date DATE NOT NULL"))
+
+
+# Creates the indexes declared on the models that the database doesn't have yet. An index is skipped if an
+# existing index or unique constraint already covers the same columns, whatever it's called.
+def create_missing_indexes(connection):
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        existing = inspector.get_indexes(table.name) + inspector.get_unique_constraints(table.name)
+        covered = {tuple(index["column_names"]) for index in existing}
+        for index in table.indexes:
+            if tuple(column.name for column in index.columns) not in covered:
+                index.create(connection)
+
+
+# Recreates the comments foreign key to blogpost with ON DELETE CASCADE.
+# SQLite can't alter foreign keys, delete_post deletes the comments itself there.
+def add_comment_cascade(connection):
+    if connection.dialect.name != "mysql":
+        return
+
+    for foreign_key in inspect(connection).get_foreign_keys("comments"):
+        if foreign_key["constrained_columns"] != ["post_id"]:
+            continue
+        if foreign_key["options"].get("ondelete", "").upper() == "CASCADE":
+            continue
+        name = foreign_key["name"]
+        connection.execute(text(f"ALTER TABLE comments DROP FOREIGN KEY `{name}`"))
+        connection.execute(text(f"ALTER TABLE comments ADD CONSTRAINT `{name}` FOREIGN KEY (post_id) "
+                                f"REFERENCES blogpost (id) ON DELETE CASCADE"))
+
+
+if __name__ == '__main__':
+    with application.app_context():
+        with db.engine.begin() as connection:
+            convert_post_dates(connection)
+            create_missing_indexes(connection)
+            add_comment_cascade(connection)
+    print("Database is up to date.")